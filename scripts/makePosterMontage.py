@@ -22,6 +22,12 @@ from PIL import Image, ImageDraw, ImageFont
 import imageio
 import numpy as np
 
+# Optional: libvips builds and writes the pyramid much faster than PIL
+try:
+    import pyvips
+except (ImportError, OSError):
+    pyvips = None
+
 
 ####
 ## This section contains the code from: https://github.com/openzoom/deepzoom.py
@@ -34,32 +40,36 @@ import numpy as np
 ## Copyright (c) 2008, Kapil Thangavelu <kapil.foss@gmail.com>
 ## All rights reserved.
 
+import concurrent.futures
 import io
 import math
 import os
 import shutil
 from urllib.parse import urlparse
 import sys
+import threading
 import time
 import urllib.request
 import warnings
-import xml.dom.minidom
 
 from collections import deque
+from multiprocessing import shared_memory
 
 
 NS_DEEPZOOM = "http://schemas.microsoft.com/deepzoom/2008"
 
 Image.MAX_IMAGE_PIXELS = None
-DEFAULT_RESIZE_FILTER = Image.ANTIALIAS
+DEFAULT_RESIZE_FILTER = Image.Resampling.LANCZOS
 DEFAULT_IMAGE_FORMAT = "png"
+TILE_BATCH_SIZE = 64
 
 RESIZE_FILTERS = {
-    "cubic": Image.CUBIC,
-    "bilinear": Image.BILINEAR,
-    "bicubic": Image.BICUBIC,
-    "nearest": Image.NEAREST,
-    "antialias": Image.ANTIALIAS,
+    "cubic": Image.Resampling.BICUBIC,
+    "bilinear": Image.Resampling.BILINEAR,
+    "bicubic": Image.Resampling.BICUBIC,
+    "nearest": Image.Resampling.NEAREST,
+    "antialias": Image.Resampling.LANCZOS,
+    "box": Image.Resampling.BOX,
 }
 
 IMAGE_FORMATS = {
@@ -88,21 +98,14 @@ class DeepZoomImageDescriptor(object):
 
     def save(self, destination):
         """Save descriptor file."""
-        file = open(destination, "wb")
-        doc = xml.dom.minidom.Document()
-        image = doc.createElementNS(NS_DEEPZOOM, "Image")
-        image.setAttribute("xmlns", NS_DEEPZOOM)
-        image.setAttribute("TileSize", str(self.tile_size))
-        image.setAttribute("Overlap", str(self.tile_overlap))
-        image.setAttribute("Format", str(self.tile_format))
-        size = doc.createElementNS(NS_DEEPZOOM, "Size")
-        size.setAttribute("Width", str(self.width))
-        size.setAttribute("Height", str(self.height))
-        image.appendChild(size)
-        doc.appendChild(image)
-        descriptor = doc.toxml(encoding="UTF-8")
-        file.write(descriptor)
-        file.close()
+        descriptor = (
+            f'<?xml version="1.0" encoding="UTF-8"?>'
+            f'<Image xmlns="{NS_DEEPZOOM}" TileSize="{self.tile_size}"'
+            f' Overlap="{self.tile_overlap}" Format="{self.tile_format}">'
+            f'<Size Width="{self.width}" Height="{self.height}"/></Image>'
+        ).encode("utf-8")
+        with open(destination, "wb") as file:
+            file.write(descriptor)
 
     @classmethod
     def remove(self, filename):
@@ -165,35 +168,75 @@ class ImageCreator(object):
         image_quality=0.8,
         resize_filter=None,
         copy_metadata=False,
+        cores=None,
+        png_compress_level=None,
     ):
         self.tile_size = int(tile_size)
         self.tile_format = tile_format
         self.tile_overlap = _clamp(int(tile_overlap), 0, 10)
         self.image_quality = _clamp(image_quality, 0, 1.0)
+        if png_compress_level is None:
+            png_compress_level = _png_compress_level(self.image_quality)
+        self.png_compress_level = _clamp(int(png_compress_level), 0, 9)
+        self.tile_bounds = _make_tile_bounds(self.tile_size, self.tile_overlap)
 
         if not tile_format in IMAGE_FORMATS:
             self.tile_format = DEFAULT_IMAGE_FORMAT
         self.resize_filter = resize_filter
         self.copy_metadata = copy_metadata
+        self.cores = cores
 
     def get_image(self, level):
-        """Returns the bitmap image at the given level."""
+        """Returns the bitmap image at the given level.
+        Each call halves the source down to that level, so this is a one-off
+        convenience; to visit several levels iterate levels() instead."""
         assert (
             0 <= level and level < self.descriptor.num_levels
         ), "Invalid pyramid level"
-        width, height = self.descriptor.get_dimensions(level)
-        # don't transform to what we already have
-        if self.descriptor.width == width and self.descriptor.height == height:
-            return self.image
+        for (level_index, level_image) in self.levels():
+            if level_index == level:
+                if isinstance(level_image, np.ndarray):
+                    return Image.fromarray(level_image)
+                return level_image
+
+    def levels(self):
+        """Iterator for bitmaps of all levels, from the finest to the coarsest.
+        Returns (level, image), where image is a PIL image or, for a source
+        array, an RGB array; each level is made by halving the previous one,
+        so only two levels are held in memory at a time."""
         if (self.resize_filter is None) or (self.resize_filter not in RESIZE_FILTERS):
-            return self.image.resize((width, height), Image.ANTIALIAS)
-        return self.image.resize((width, height), RESIZE_FILTERS[self.resize_filter])
+            resize_filter = DEFAULT_RESIZE_FILTER
+        else:
+            resize_filter = RESIZE_FILTERS[self.resize_filter]
+
+        level_image = self.image
+        for level in reversed(range(self.descriptor.num_levels)):
+            # rounding up the halved dimensions of the finer level gives the
+            # dimensions of the descriptor; a level of the same size as the
+            # previous one, such as the finest level, is reused as it is
+            width, height = self.descriptor.get_dimensions(level)
+            if _get_size(level_image) != (width, height):
+                if (isinstance(level_image, np.ndarray)
+                        and level_image.shape[:2] == (2 * height, 2 * width)):
+                    # exact halving of an array, such as the montage canvas,
+                    # is done in NumPy without a full-size PIL copy of it
+                    level_image = _halve_array(level_image)
+                else:
+                    if isinstance(level_image, np.ndarray):
+                        level_image = Image.fromarray(level_image)
+                    if level_image.size == (2 * width, 2 * height):
+                        # exact halving: averaging 2x2 pixels is as good as the
+                        # resize filter and much cheaper
+                        level_image = level_image.resize((width, height), Image.Resampling.BOX)
+                    else:
+                        level_image = level_image.resize((width, height), resize_filter)
+            yield (level, level_image)
 
     def tiles(self, level):
         """Iterator for all tiles in the given level. Returns (column, row) of a tile."""
         columns, rows = self.descriptor.get_num_tiles(level)
-        for column in range(columns):
-            for row in range(rows):
+        for row in range(rows):
+            for column in range(columns):
                 yield (column, row)
 
     def create(self, source, destination):
@@ -202,9 +245,16 @@ class ImageCreator(object):
         # Open the source image for DZI tiling from a file
         #self.image = Image.open(safe_open(source))
 
-        # The source image for DZI tiling is a PIL.Image objects
+        # The source image for DZI tiling is a PIL.Image object or an RGB
+        # ndarray; an array is tiled at the finest level without a copy.
+        # Tiles are cut from RGB bitmaps, other modes are converted once here
+        if isinstance(source, np.ndarray):
+            if source.dtype != np.uint8 or source.ndim != 3 or source.shape[2] != 3:
+                source = np.asarray(Image.fromarray(source).convert("RGB"))
+        elif source.mode != "RGB":
+            source = source.convert("RGB")
         self.image = source
-        width, height = self.image.size
+        width, height = _get_size(self.image)
 
         self.descriptor = DeepZoomImageDescriptor(
             width=width,
@@ -217,37 +267,185 @@ class ImageCreator(object):
         # Create tiles
         image_files = _get_or_create_path(_get_files_path(destination))
 
-        # Parallelization?
-        for level in range(self.descriptor.num_levels):
+        tile_bounds = self.tile_bounds
+        format = self.descriptor.tile_format
+
+        # Tiles are written in parallel; levels are processed one after another.
+        # Worker processes read each level from POSIX shared memory (/dev/shm),
+        # which must hold the full-size montage. Threads, which slice the level
+        # directly, are used on Windows, where worker processes cannot be forked,
+        # and when /dev/shm is too small, e.g. the 64 MB default of Docker.
+        # PIL releases the GIL while encoding, so threads still run in parallel.
+        use_shm = os.name != "nt" and _fits_shared_memory(width * height * 3)
+        if use_shm:
+            executor_class = concurrent.futures.ProcessPoolExecutor
+        else:
+            executor_class = concurrent.futures.ThreadPoolExecutor
+
+        with executor_class(
+            max_workers=self.cores,
+            initializer=_init_tile_worker,
+            initargs=(
+                self.descriptor.tile_format,
+                self.image_quality,
+                self.png_compress_level,
+            ),
+        ) as executor:
+            for (level, level_image) in self.levels():
 
-            if (DEB):
-                print("Pyramid level %d" % level)
+                if (DEB):
+                    print("Pyramid level %d" % level)
 
-            level_dir = _get_or_create_path(os.path.join(image_files, str(level)))
-            level_image = self.get_image(level)
+                level_dir = _get_or_create_path(os.path.join(image_files, str(level)))
+                level_array = np.asarray(level_image)
 
-            for (column, row) in self.tiles(level):
+                # Level dimensions are looked up once per level instead of once per tile
+                level_height, level_width = level_array.shape[:2]
 
-                if (DEB):
-                    print("Pyramid col x row: %d %d" % (column, row))
+                tiles = []
+                for (column, row) in self.tiles(level):
 
-                bounds = self.descriptor.get_tile_bounds(level, column, row)
-                tile = level_image.crop(bounds)
-                format = self.descriptor.tile_format
-                tile_path = os.path.join(level_dir, "%s_%s.%s" % (column, row, format))
-                tile_file = open(tile_path, "wb")
+                    if (DEB):
+                        print("Pyramid col x row: %d %d" % (column, row))
 
-                if self.descriptor.tile_format == "jpg":
-                    jpeg_quality = int(self.image_quality * 100)
-                    tile.save(tile_file, "JPEG", quality=jpeg_quality)
-                else:
-                    png_compress = round((1 - self.image_quality)*10)
-                    tile.save(tile_file, compress_level = png_compress)
+                    tile_path = os.path.join(level_dir, "%s_%s.%s" % (column, row, format))
+                    tiles.append(tile_bounds(level_width, level_height, column, row) + (tile_path,))
+
+                level_shm = None
+                try:
+                    if use_shm:
+                        # Share the level bitmap with the worker processes
+                        # instead of pickling it per tile
+                        level_shm = shared_memory.SharedMemory(create=True, size=level_array.nbytes)
+                        shm_array = np.ndarray(level_array.shape, dtype=level_array.dtype, buffer=level_shm.buf)
+                        shm_array[:] = level_array
+                        level_source = (level_shm.name, level_array.shape)
+                        del shm_array, level_array
+                        # Unmap it here before workers are forked, or they would
+                        # inherit the mapping and keep the level resident
+                        level_shm.close()
+                    else:
+                        level_source = level_array
+
+                    # Tiles are sent to the workers in batches to amortise task overhead
+                    tasks = [
+                        (level_source, tiles[i:i + TILE_BATCH_SIZE])
+                        for i in range(0, len(tiles), TILE_BATCH_SIZE)
+                    ]
+                    for _ in executor.map(_write_tile_batch, tasks):
+                        pass
+                finally:
+                    if level_shm is not None:
+                        level_shm.close()
+                        level_shm.unlink()
 
         # Create descriptor
         self.descriptor.save(destination)
 
 
+# State of a tile writer; one per worker process or thread
+_tile_worker = threading.local()
+
+def _init_tile_worker(tile_format, image_quality, png_compress_level):
+    _tile_worker.tile_format = tile_format
+    _tile_worker.image_quality = image_quality
+    _tile_worker.png_compress_level = png_compress_level
+    # encoding buffer reused for all tiles written by this worker
+    _tile_worker.buffer = io.BytesIO()
+
+def _write_tile_batch(task):
+    """Crops a batch of tiles from the level bitmap and saves them.
+    Thread workers get the array itself; worker processes get (name, shape)
+    of the shared memory block and detach from it when the batch is done,
+    so that tmpfs can free an unlinked level as soon as it is tiled."""
+    level_source, batch = task
+    if isinstance(level_source, np.ndarray):
+        _write_tiles(level_source, batch)
+        return
+
+    shm_name, shape = level_source
+    level_shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        _write_tiles(np.ndarray(shape, dtype=np.uint8, buffer=level_shm.buf), batch)
+    finally:
+        level_shm.close()
+
+def _write_tiles(level_array, batch):
+    band_rows = None
+    for x1, y1, x2, y2, tile_path in batch:
+        # the band of rows is contiguous in memory and shared by
+        # consecutive tiles of a tile row
+        if band_rows != (y1, y2):
+            band_rows = (y1, y2)
+            band = level_array[y1:y2]
+        _save_tile(Image.fromarray(band[:, x1:x2]), tile_path)
+
+def _save_tile(tile, tile_path):
+    """Encodes a tile in the format of the pyramid and writes it to a file."""
+    # Encode in memory and write the file with a single write; a buffered file
+    # writes the whole buffer, large writes bypass its internal copy
+    tile_buffer = _tile_worker.buffer
+    tile_buffer.seek(0)
+    tile_buffer.truncate()
+    if _tile_worker.tile_format == "jpg":
+        jpeg_quality = int(_tile_worker.image_quality * 100)
+        tile.save(tile_buffer, "JPEG", quality=jpeg_quality)
+    else:
+        tile.save(tile_buffer, "PNG", compress_level = _tile_worker.png_compress_level)
+
+    with open(tile_path, "wb") as tile_file:
+        with tile_buffer.getbuffer() as tile_bytes:
+            tile_file.write(tile_bytes)
+
+def _fits_shared_memory(nbytes):
+    """Whether a block of nbytes fits into POSIX shared memory; writing past
+    the free space of /dev/shm kills the process with SIGBUS."""
+    if not os.path.isdir("/dev/shm"):
+        return True
+    return shutil.disk_usage("/dev/shm").free >= nbytes
+
+def _png_compress_level(image_quality):
+    """zlib compression level (0-9) of PNG tiles for an image quality (0-1)."""
+    return _clamp(int(round((1 - image_quality) * 9)), 0, 9)
+
+def _make_tile_bounds(tile_size, tile_overlap):
+    """Returns a function computing tile bounds as get_tile_bounds does, with
+    the tile geometry fixed: tile_bounds(level_width, level_height, column, row)."""
+    # extent of the first tile and of any further tile, including overlaps
+    first_span = tile_size + tile_overlap
+    span = tile_size + 2 * tile_overlap
+
+    def tile_bounds(level_width, level_height, column, row):
+        if column == 0:
+            x1, x2 = 0, first_span
+        else:
+            x1 = column * tile_size - tile_overlap
+            x2 = x1 + span
+        if row == 0:
+            y1, y2 = 0, first_span
+        else:
+            y1 = row * tile_size - tile_overlap
+            y2 = y1 + span
+        return (x1, y1, min(x2, level_width), min(y2, level_height))
+
+    return tile_bounds
+
+def _halve_array(image):
+    """Halves an RGB image array with even dimensions by averaging 2x2 pixels."""
+    halved = image[0::2, 0::2].astype(np.uint16)
+    halved += image[1::2, 0::2]
+    halved += image[0::2, 1::2]
+    halved += image[1::2, 1::2]
+    halved += 2
+    halved //= 4
+    return halved.astype(np.uint8)
+
+def _get_size(image):
+    """Size (width, height) of a PIL image or an image array."""
+    if isinstance(image, np.ndarray):
+        return (image.shape[1], image.shape[0])
+    return image.size
+
 def _get_or_create_path(path):
     if not os.path.exists(path):
         os.makedirs(path)
@@ -325,7 +523,7 @@ def parseArguments():
         parser.add_argument(
                 '-r',
                 '--cores',
-                help='Number of cores for multiprocessing, default 4 (NOT USED)',
+                help='Number of cores for image loading and tile writing (libvips threads if pyvips is installed), default 4',
                 type=int,
                 default=4)
 
@@ -339,10 +537,17 @@ def parseArguments():
         parser.add_argument(
                 '-q',
                 '--imquality',
-                help='Image quality (0.1 - 1) for JPG or compression level for PNG, default 0.8.',
+                help='Image quality (0.1 - 1) for JPG or compression level for PNG, default 0.8 (PNG compression level 2).',
                 type=float,
                 default=0.8)
 
+        parser.add_argument(
+                '-s',
+                '--fasttiles',
+                help='Fast PNG tiles; use compression level 1 regardless of the image quality.',
+                default=False,
+                action="store_true")
+
         # Parse arguments
         args = parser.parse_args()
         args.griddim = tuple(args.griddim)
@@ -351,6 +556,39 @@ def parseArguments():
         return args
 
 
+def loadImage(path, out):
+        """Read an image file into the array out; returns False if the file is inaccessible/corrupt."""
+        # grayscale and palette images are expanded and alpha channel is dropped
+        # when the image is opened, so that the montage and tiles are all RGB
+        # only the first frame of animated/multi-page files is used
+        try:
+                locIm = imageio.v3.imread(path, plugin='pillow', index=0, mode='RGB')
+        except (IOError, SyntaxError, IndexError, ValueError) as e:
+                return False
+
+        # an image of other dimensions than the grid slot is also skipped
+        if locIm.shape != out.shape:
+                return False
+
+        out[:] = locIm
+        return True
+
+
+def makeDZIvips(canvas, destination, tile_size, png_compress_level, cores):
+        """Make a DZI pyramid of the montage with libvips; tiles are encoded by its thread pool of size cores."""
+        pyvips.concurrency_set(cores)
+
+        imHeight, imWidth, imBands = canvas.shape
+        im = pyvips.Image.new_from_memory(canvas.data, imWidth, imHeight, imBands, 'uchar')
+
+        _get_or_create_path(os.path.dirname(destination) or '.')
+        im.dzsave(
+                os.path.splitext(destination)[0],
+                tile_size=tile_size,
+                overlap=1,
+                suffix='.png[compression=%d]' % png_compress_level)
+
+
 if __name__ == "__main__":
 
     args = parseArguments()
@@ -413,16 +651,19 @@ if __name__ == "__main__":
 
     # Work
 
-    # create canvas for montage of the entire grid
-    imGrid = Image.new(imMode, (imGridWidth, imGridHeight), bgEmptyGrid)
+    # create canvas for montage of the entire grid;
+    # the colour is unpacked as PIL does for an integer colour of an RGB image
+    bgEmptyGridRGB = (bgEmptyGrid & 0xFF, (bgEmptyGrid >> 8) & 0xFF, (bgEmptyGrid >> 16) & 0xFF)
+    canvas = np.full((imGridHeight, imGridWidth, 3), bgEmptyGridRGB, dtype=np.uint8)
 
     if (DEB):
         print("Making the montage:")
         print(imGridWidth, "x", imGridHeight, "pixels")
 
     # all image files for processing
-    files = [f for f in os.listdir(imDir) if os.path.isfile(os.path.join(imDir, f)) and f.endswith(imExt)]
-    files.sort()
+    # (directory entries know their type, so no stat call is needed per file)
+    with os.scandir(imDir) as imDirEntries:
+        files = sorted(e.name for e in imDirEntries if e.name.endswith(imExt) and e.is_file())
 
     if (DEB):
         print("\n", len(files), "file(s) found in the input directory")
@@ -431,60 +672,57 @@ if __name__ == "__main__":
     if (len(files) > gridWidth * gridHeight):
         print("\nWarning:\nspecified grid dimensions smaller than the number of images in the input folder.")
 
-    # Iterator over all image files
-    iiIm = 0
-
-    for iRow in gridRow:
-        for iCol in gridCol:
-
-            if (iiIm < len(files)):
-                locImPath = os.path.join(imDir, files[iiIm])
-
-                if (DEB):
-                    print('\nTrying file:')
-                    print(locImPath)
-
-                # Handle errors if the image file is inaccessible/corrupt
-                flagFileExists = os.path.isfile(locImPath) and os.access(locImPath, os.R_OK)
-                flagFileOK = True
-
-                try:
-                    locIm = Image.open(locImPath)
-                except (IOError, SyntaxError, IndexError, ValueError) as e:
-                    print('Corrupted file:', locImPath)
-                    flagFileOK = False
-
-                # Add image to montage canvas
+    # Images placed in the grid, row by row, and their slots in the montage canvas
+    imPaths = [os.path.join(imDir, f) for f in files[:gridWidth * gridHeight]]
+    gridBoxes = []
+    gridSlots = []
+    for iiIm in range(len(imPaths)):
+        iRow, iCol = divmod(iiIm, gridWidth)
+        gridPosW = iCol * (imWidth + padding)
+        gridPosE = gridPosW + imWidth
+        gridPosN = iRow * (imHeight + padding)
+        gridPosS = gridPosN + imHeight
+        gridBoxes.append((gridPosW, gridPosN, gridPosE, gridPosS))
+        gridSlots.append(canvas[gridPosN:gridPosS, gridPosW:gridPosE])
+
+    # Images are decoded in parallel, each straight into its slot of the canvas
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.cores) as executor:
+        for locImPath, bbox, locImOK in zip(imPaths, gridBoxes, executor.map(loadImage, imPaths, gridSlots)):
 
-                gridPosW = iCol * (imWidth + padding)
-                gridPosE = gridPosW + imWidth
-                gridPosN = iRow * (imHeight + padding)
-                gridPosS = gridPosN + imHeight
-                bbox = (gridPosW, gridPosN, gridPosE, gridPosS)
-
-                if (DEB):
-                    print('\nBounding box for inserting the image into grid canvas:')
-                    print(bbox)
-
-
-                imGrid.paste(locIm, bbox)
-
-            iiIm += 1
+            if (DEB):
+                print('\nTrying file:')
+                print(locImPath)
+                print('\nBounding box for inserting the image into grid canvas:')
+                print(bbox)
 
+            # Handle errors if the image file is inaccessible/corrupt;
+            # its slot keeps the colour of the empty canvas
+            if not locImOK:
+                print('Corrupted file:', locImPath)
 
     imPathDir = '%s/%s.dzi' % (args.outdir, args.outfile)
     if (DEB):
         print("\nMaking DeepZoom tiling in:\n" + imPathDir)
 
+    # zlib compression level of PNG tiles
+    if args.fasttiles:
+        pngCompress = 1
+    else:
+        pngCompress = _png_compress_level(args.imquality)
 
-    creator = ImageCreator(
-        tile_size = args.tilesz,
-        tile_format = 'png',
-        image_quality = args.imquality,
-        resize_filter = 'antialias',
-    )
+    if pyvips is not None:
+        makeDZIvips(canvas, imPathDir, args.tilesz, pngCompress, args.cores)
+    else:
+        creator = ImageCreator(
+            tile_size = args.tilesz,
+            tile_format = 'png',
+            image_quality = args.imquality,
+            resize_filter = 'antialias',
+            cores = args.cores,
+            png_compress_level = pngCompress,
+        )
 
-    creator.create(imGrid, imPathDir)
+        creator.create(canvas, imPathDir)
 
     if(DEB):
         print("\nAnalysis finished!\n")